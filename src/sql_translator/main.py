@@ -1,12 +1,106 @@
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
 from pathlib import Path
+from typing import List, Optional, Tuple
 from sqlglot.errors import ParseError
 from translator import SQLTranslator
 
+# One translator per process, created on first use, so its tokenizer,
+# parser and generator are reused for every file that process handles
+_translator: Optional[SQLTranslator] = None
+
+
+def _get_translator() -> SQLTranslator:
+    """Return this process's translator, creating it on first use."""
+    global _translator
+    if _translator is None:
+        _translator = SQLTranslator()
+    return _translator
+
+
+def _translate_file(input_file: Path, output_file: Path) -> None:
+    """Translate one SQL file, writing output as it is generated."""
+    # Read input SQL
+    sql = input_file.read_bytes().decode('utf-8', errors='surrogateescape')
+
+    # Translate SQL; parsing and rewriting all happen before the first
+    # chunk, so a failure there leaves any existing output untouched
+    chunks = _get_translator().translate_stream(sql)
+    first_chunk = next(chunks)
+
+    # Write output SQL as it is generated
+    with open(output_file, 'wb') as f:
+        for chunk in chain([first_chunk], chunks):
+            f.write(chunk.encode('utf-8', errors='surrogateescape'))
+
+
+def _translate_one(pair: Tuple[str, str]) -> Optional[str]:
+    """Translate an (input, output) pair, returning an error message."""
+    input_file, output_file = Path(pair[0]), Path(pair[1])
+    if not input_file.exists():
+        return f"Error: Input file {input_file} does not exist"
+    try:
+        _translate_file(input_file, output_file)
+    except ParseError as e:
+        return f"Error parsing SQL in {input_file}: {e}"
+    except Exception as e:
+        return f"Error translating SQL in {input_file}: {e}"
+    return None
+
+
+def main_batch(pairs: List[Tuple[str, str]]) -> int:
+    """Translate (input, output) pairs in parallel; return failure count."""
+    failures = 0
+    # Each worker builds its translator once, up front, and reuses it for
+    # every file it is handed
+    with ProcessPoolExecutor(initializer=_get_translator) as executor:
+        for pair, error in zip(
+            pairs, executor.map(_translate_one, pairs, chunksize=8)
+        ):
+            if error:
+                failures += 1
+                print(error)
+            else:
+                print(f"Successfully translated SQL from {pair[0]} "
+                      f"to {pair[1]}")
+    return failures
+
+
+def _read_manifest(manifest_file: Path) -> List[Tuple[str, str]]:
+    """Read whitespace-separated input/output path pairs, one per line."""
+    pairs = []
+    with open(manifest_file, 'r') as f:
+        for line_no, line in enumerate(f, 1):
+            fields = line.split()
+            if not fields:
+                continue
+            if len(fields) != 2:
+                raise ValueError(
+                    f"line {line_no}: expected '<input> <output>'"
+                )
+            pairs.append((fields[0], fields[1]))
+    return pairs
+
 
 def main():
+    if len(sys.argv) == 3 and sys.argv[1] == '--batch':
+        manifest_file = Path(sys.argv[2])
+        if not manifest_file.exists():
+            print(f"Error: Manifest file {manifest_file} does not exist")
+            sys.exit(1)
+        try:
+            pairs = _read_manifest(manifest_file)
+        except ValueError as e:
+            print(f"Error reading manifest {manifest_file}: {e}")
+            sys.exit(1)
+        if main_batch(pairs):
+            sys.exit(1)
+        return
+
     if len(sys.argv) != 3:
         print("Usage: python main.py <input_sql_file> <output_sql_file>")
+        print("       python main.py --batch <manifest_file>")
         sys.exit(1)
 
     input_file = Path(sys.argv[1])
@@ -16,18 +110,8 @@ def main():
         print(f"Error: Input file {input_file} does not exist")
         sys.exit(1)
 
-    # Read input SQL
-    with open(input_file, 'r') as f:
-        sql = f.read()
-
     try:
-        # Translate SQL
-        translator = SQLTranslator()
-        translated_sql = translator.translate(sql)
-
-        # Write output SQL
-        with open(output_file, 'w') as f:
-            f.write(translated_sql)
+        _translate_file(input_file, output_file)
     except ParseError as e:
         print(f"Error parsing SQL: {e}")
         sys.exit(1)
@@ -1,11 +1,53 @@
-import re
-from typing import Dict, List, Set
+import sys
+from collections import Counter, deque
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 from dataclasses import dataclass
-from sqlglot import exp, parse_one
+from sqlglot import exp
+from sqlglot.errors import ParseError, UnsupportedError
 from sqlglot.dialects import Redshift, Databricks
 
 
-@dataclass
+class _DatabricksGenerator(Databricks.Generator):
+    """Databricks generator that leaves nested WITH clauses in place."""
+    # Databricks accepts CTEs inside subqueries; hoisting them would pull
+    # the rewrite subqueries' CTEs out of the scope of their columns
+    EXPRESSIONS_WITHOUT_NESTED_CTES: Set[type] = set()
+
+
+def _is_not_null(sql_exp: exp.Expression) -> exp.Expression:
+    """Build ``<sql_exp> IS NOT NULL``."""
+    return exp.Not(this=exp.Is(this=sql_exp, expression=exp.Null()))
+
+
+def _check_default_args(
+    node: exp.Expression, func_name: str, defaults: Dict[str, Optional[int]]
+) -> None:
+    """Raise for arguments that differ from their no-op default."""
+    # A default of None means the argument has no Databricks equivalent at
+    # all; the generator would otherwise drop it with only a warning
+    for arg, default in defaults.items():
+        value = node.args.get(arg)
+        if value is None:
+            continue
+        if default is None or not (value.is_int and value.to_py() == default):
+            raise UnsupportedError(
+                f"{func_name} argument '{arg}' is not supported in Databricks"
+            )
+
+
+def _cte_subquery(
+    cte_name: str, column: str, value: exp.Expression,
+    projection: exp.Expression
+) -> exp.Subquery:
+    """Build ``(WITH cte AS (SELECT value AS column) SELECT ... FROM cte)``."""
+    return exp.Subquery(
+        this=exp.select(projection)
+        .from_(cte_name)
+        .with_(cte_name, as_=exp.select(exp.alias_(value, column)))
+    )
+
+
+@dataclass(slots=True)
 class CTENode:
     """Represents a CTE node in the SQL graph."""
     name: str
@@ -19,47 +61,154 @@ class SQLTranslator:
     def __init__(self):
         self.cte_counter = 0
         self.cte_graph: Dict[str, CTENode] = {}
+        # Dialect machinery is built once per translator and reused for
+        # every call; parsers and generators keep per-call state, so they
+        # are not shared between translators (or threads)
+        redshift = Redshift()
+        self._tokenizer = redshift.tokenizer()
+        self._parser = redshift.parser()
+        self._gen = _DatabricksGenerator(dialect=Databricks())
+        # Most recent (sql, tree) pair, so re-translating the same input
+        # skips the parse without holding on to every tree ever parsed
+        self._last_parse: Optional[Tuple[str, exp.Expression]] = None
+
+    def _parse(self, sql: str) -> exp.Expression:
+        """Parse Redshift SQL, reusing the tree for a repeated input."""
+        if self._last_parse is None or self._last_parse[0] != sql:
+            result = self._parser.parse(self._tokenizer.tokenize(sql), sql)
+            if not result or result[0] is None:
+                raise ParseError(f"No expression was parsed from '{sql}'")
+            sql_exp = (
+                exp.Block(expressions=result) if len(result) > 1
+                else result[0]
+            )
+            self._last_parse = (sql, sql_exp)
+        return self._last_parse[1]
 
     def _generate_cte_name(self) -> str:
         """Generate unique CTE names."""
         self.cte_counter += 1
-        return f"cte_alias_{self.cte_counter}"
+        return sys.intern(f"cte_alias_{self.cte_counter}")
 
     def _build_cte_graph(self, sql_exp: exp.Expression) -> None:
         """Build a graph of CTE dependencies."""
-        if isinstance(sql_exp, exp.With):
-            for cte in sql_exp.expressions:
-                cte_name = str(cte.alias)
-                cte_sql = cte.expression
-                references = set()
-                aliases = {}
-
-                # Find CTE references and column aliases
-                for node in cte_sql.walk():
-                    if (isinstance(node, exp.Table) and
-                            str(node) in self.cte_graph):
-                        references.add(str(node))
-                    elif isinstance(node, exp.Alias):
-                        aliases[str(node.alias)] = str(node.expression)
+        # Facts gathered in one pre-order pass; which CTEs the graph owns
+        # is only known once every name in the statement has been seen
+        ctes = []
+        references = []
+        aliases = []
+        table_names = set()
+
+        # Handlers get the innermost enclosing CTE and the CTEs visible by
+        # name, and return the CTE that owns the node's children
+        def on_cte(node, owner, scope):
+            ctes.append((node, owner))
+            return node
+
+        def on_table(node, owner, scope):
+            if not node.db:
+                target = scope.get(node.name)
+                if target is None:
+                    table_names.add(node.name)
+                elif owner is not None and target is not owner:
+                    references.append((owner, target))
+            return owner
+
+        def on_alias(node, owner, scope):
+            if owner is not None:
+                aliases.append((owner, node))
+            return owner
+
+        dispatch = {
+            exp.CTE: on_cte,
+            exp.Table: on_table,
+            exp.Alias: on_alias,
+        }
+
+        stack = [(sql_exp, None, {})]
+        while stack:
+            node, owner, scope = stack.pop()
+            handler = dispatch.get(type(node))
+            if handler:
+                owner = handler(node, owner, scope)
+            # Visit WITH clauses before the query that may reference them
+            children = sorted(
+                node.iter_expressions(),
+                key=lambda child: not isinstance(child, exp.With)
+            )
+            scopes = self._child_scopes(node, children, scope)
+            stack.extend(
+                (child, owner, child_scope)
+                for child, child_scope in reversed(list(zip(children, scopes)))
+            )
 
+        # A nested CTE whose name is defined again or used as a table
+        # elsewhere would change what that name means if hoisted, so it
+        # stays in place; top-level CTEs are always hoisted
+        name_counts = Counter(cte.alias for cte, _ in ctes)
+        parents = {id(cte): owner for cte, owner in ctes}
+        owned = {
+            id(cte) for cte, _ in ctes
+            if cte.parent.parent is sql_exp or (
+                name_counts[cte.alias] == 1 and cte.alias not in table_names
+            )
+        }
+
+        def owning(cte):
+            while cte is not None and id(cte) not in owned:
+                cte = parents[id(cte)]
+            return cte
+
+        for cte, _ in ctes:
+            if id(cte) in owned:
+                cte_name = sys.intern(cte.alias)
                 self.cte_graph[cte_name] = CTENode(
                     name=cte_name,
-                    sql=cte_sql,
-                    references=references,
+                    sql=cte.this,
+                    references=set(),
                     referenced_by=set(),
-                    aliases=aliases
+                    aliases={}
+                )
+        for owner, target in references:
+            owner = owning(owner)
+            if owner is None or owner is target or id(target) not in owned:
+                continue
+            self.cte_graph[owner.alias].references.add(target.alias)
+            self.cte_graph[target.alias].referenced_by.add(owner.alias)
+        for owner, alias in aliases:
+            owner = owning(owner)
+            if owner is not None:
+                self.cte_graph[owner.alias].aliases[alias.alias] = (
+                    alias.this.sql()
                 )
 
-            # Update referenced_by relationships
-            for node in self.cte_graph.values():
-                for ref in node.references:
-                    if ref in self.cte_graph:
-                        self.cte_graph[ref].referenced_by.add(node.name)
-
-        # Process nested queries
-        for child in sql_exp.walk():
-            if isinstance(child, exp.Select):
-                self._build_cte_graph(child)
+    @staticmethod
+    def _child_scopes(
+        node: exp.Expression, children: List[exp.Expression],
+        scope: Dict[str, exp.CTE]
+    ) -> List[Dict[str, exp.CTE]]:
+        """Work out which CTEs each child of node can refer to by name."""
+        if isinstance(node, exp.With):
+            # A CTE sees the ones defined before it, or all if recursive
+            if node.args.get('recursive'):
+                visible = {**scope, **{cte.alias: cte for cte in children}}
+                return [visible] * len(children)
+            scopes = []
+            visible = dict(scope)
+            for cte in children:
+                scopes.append(visible)
+                visible = {**visible, cte.alias: cte}
+            return scopes
+        with_ = children[0] if (
+            children and isinstance(children[0], exp.With)
+        ) else None
+        if with_ is None:
+            return [scope] * len(children)
+        # The query's own WITH is in scope everywhere but inside itself
+        visible = {
+            **scope, **{cte.alias: cte for cte in with_.expressions}
+        }
+        return [scope] + [visible] * (len(children) - 1)
 
     def _handle_column_aliases(
         self, sql_exp: exp.Expression
@@ -73,207 +222,290 @@ class SQLTranslator:
         aliases = {}
         alias_references = set()
 
-        for node in sql_exp.walk():
-            if isinstance(node, exp.Alias):
-                aliases[str(node.alias)] = node
-            elif isinstance(node, exp.Column) and str(node) in aliases:
-                alias_references.add(str(node))
+        # Aliases are only introduced by the projection list
+        for proj in sql_exp.expressions:
+            if isinstance(proj, exp.Alias):
+                aliases[proj.alias] = proj
+
+        for proj in sql_exp.expressions:
+            for col in proj.find_all(exp.Column):
+                # Qualified columns such as b.y name a table column
+                if not col.table and col.name in aliases:
+                    alias_references.add(col.name)
 
         if alias_references:
             # Create a new CTE for this SELECT
             cte_name = self._generate_cte_name()
+            references = {
+                table.name for table in sql_exp.find_all(exp.Table)
+                if table.name in self.cte_graph
+            }
+            for ref in references:
+                self.cte_graph[ref].referenced_by.add(cte_name)
             # Create the CTE node
             cte_node = CTENode(
                 name=cte_name,
                 sql=sql_exp,
-                references=set(),
+                references=references,
                 referenced_by=set(),
                 aliases=aliases
             )
             self.cte_graph[cte_name] = cte_node
 
             # Return a new SELECT that references the CTE
-            return exp.select("*").from_(exp.Table(cte_name))
+            return exp.select("*").from_(exp.to_table(cte_name))
 
         return sql_exp
 
-    def _handle_ignore_nulls(self, sql: str) -> str:
+    def _handle_ignore_nulls(self, window: exp.Window) -> exp.Window:
         """Replace IGNORE NULLS with Databricks equivalent CASE statements."""
-        pattern = (
-            r'(FIRST_VALUE|'
-            r'LAST_VALUE)'
-            r'\((.*?)\)'
-            r'\s+IGNORE\s+NULLS\s+OVER\s*\((.*?)\)'
+        func = window.this.this
+        expr = func.this
+        # Argument-less functions such as ROW_NUMBER() have nothing to wrap
+        if expr is None:
+            return window
+        func.set('this', exp.case().when(_is_not_null(expr.copy()), expr))
+        window.set('this', func)
+        return window
+
+    def _handle_string_concat(self, node: exp.Add) -> exp.Expression:
+        """Replace string concatenation using + with concat()."""
+        # Flatten the left-nested chain a + b + c into [a, b, c]
+        operands = []
+        left = node
+        while isinstance(left, exp.Add):
+            operands.append(left.expression)
+            left = left.this
+        operands.append(left)
+        operands.reverse()
+
+        if not any(operand.is_string for operand in operands):
+            return node
+        return exp.Concat(
+            expressions=[self._transform(operand) for operand in operands]
         )
 
-        def replace_ignore_nulls(match):
-            func = match.group(1)
-            expr = match.group(2)
-            window = match.group(3)
-            return (
-                f"{func}(CASE WHEN {expr} IS NOT NULL THEN {expr} END) "
-                f"OVER ({window})"
-            )
-
-        # Handle both FIRST_VALUE and LAST_VALUE
-        sql = re.sub(
-            pattern,
-            replace_ignore_nulls,
-            sql,
-            flags=re.IGNORECASE | re.DOTALL
+    def _handle_regexp_substr(
+        self, node: exp.RegexpExtract
+    ) -> exp.Expression:
+        """Convert regexp_substr to Databricks regexp_extract."""
+        _check_default_args(
+            node, 'regexp_substr', {'occurrence': 1, 'parameters': None}
         )
 
-        # Handle other window functions with IGNORE NULLS
-        pattern = (
-            r'([A-Za-z_][A-Za-z0-9_]*)\((.*?)\)\s+'
-            r'IGNORE\s+NULLS\s+OVER\s*\((.*?)\)'
+        position = node.args.get('position')
+        node.set('position', None)
+        node.set('occurrence', None)
+        if position is None:
+            group = exp.Literal.number(0)
+        elif position.is_int:
+            group = exp.Literal.number(position.to_py() - 1)
+        else:
+            group = exp.Sub(this=position, expression=exp.Literal.number(1))
+        node.set('group', group)
+
+        # Handle lookbehind patterns specially
+        pattern = node.expression
+        if pattern.is_string and "?<=" in pattern.name:
+            # Convert lookbehind pattern to a more compatible form
+            cte_name = self._generate_cte_name()
+            pattern.replace(exp.Literal.string(
+                pattern.name.replace("(?<=\\()", "\\(")
+                .replace("(?<=", "")
+            ))
+            # Only the operands still need rewriting; running node itself
+            # back through _rewrite would convert it a second time
+            node.set('this', self._transform(node.this))
+            node.set('group', self._transform(node.args['group']))
+            return _cte_subquery(
+                cte_name, 'match', node, exp.column('match')
+            )
+        return node
+
+    def _handle_regexp_instr(self, node: exp.RegexpInstr) -> exp.Subquery:
+        """Replace regexp_instr with regexp_extract and length."""
+        _check_default_args(node, 'regexp_instr', {
+            'position': 1, 'occurrence': 1, 'option': 0,
+            'parameters': None, 'group': None
+        })
+        extract = exp.RegexpExtract(
+            this=self._transform(node.this),
+            expression=self._transform(node.expression),
+            group=exp.Literal.number(0)
         )
-        return re.sub(
-            pattern, replace_ignore_nulls, sql, flags=re.IGNORECASE | re.DOTALL
+        match = exp.column('match')
+        return _cte_subquery(
+            'regexp_match', 'match', extract,
+            exp.case()
+            .when(_is_not_null(match), exp.Length(this=match.copy()))
+            .else_(exp.Literal.number(0))
         )
 
-    def _handle_string_concat(self, sql: str) -> str:
-        """Replace string concatenation using + with concat()."""
-        def concat_handler(match):
-            parts = []
-            current_pos = 0
-            text = match.group(0)
-
-            while current_pos < len(text):
-                if text[current_pos] == "'":
-                    end_quote = text.find("'", current_pos + 1)
-                    if end_quote != -1:
-                        parts.append(text[current_pos:end_quote + 1])
-                        current_pos = end_quote + 1
-                    else:
-                        parts.append(text[current_pos:])
-                        break
-                elif text[current_pos] == '+':
-                    parts.append(',')
-                else:
-                    parts.append(text[current_pos])
-                current_pos += 1
-
-            return f"concat({(''.join(parts)).strip()})"
-
-        pattern = (
-            r"(?:[a-zA-Z_][a-zA-Z0-9_]*|'[^']*')\s*"
-            r"(?:\+\s*(?:[a-zA-Z_][a-zA-Z0-9_]*|'[^']*'))+?"
-        )
-        return re.sub(pattern, concat_handler, sql)
-
-    def _handle_regexp_functions(self, sql: str) -> str:
-        """Convert regexp functions to Databricks format."""
-        def regexp_substr_handler(match):
-            expr, pattern = match.group(1), match.group(2)
-            pos = match.group(3) if match.group(3) else "1"
-
-            # Handle lookbehind patterns specially
-            if "?<=" in pattern:
-                # Convert lookbehind pattern to a more compatible form
-                cte_name = self._generate_cte_name()
-                pattern = (
-                    pattern.replace("(?<=\\()", "\\(")
-                    .replace("(?<=", "")
-                )
-                cte_query = (
-                    f"(WITH {cte_name} AS "
-                    f"(SELECT regexp_extract({expr}, {pattern}, "
-                    f"{int(pos)-1}) as match) "
-                    f"SELECT match FROM {cte_name})"
-                )
-                return cte_query
-            return f"regexp_extract({expr}, {pattern}, {int(pos)-1})"
-
-        sql = re.sub(
-            r'regexp_substr\((.*?),\s*([^,]+)(?:,\s*(\d+)(?:,\s*(\d+))?)?\)',
-            regexp_substr_handler,
-            sql,
-            flags=re.IGNORECASE
+    def _handle_regexp_count(self, node: exp.RegexpCount) -> exp.Subquery:
+        """Replace regexp_count with the size of regexp_extract_all."""
+        _check_default_args(
+            node, 'regexp_count', {'position': 1, 'parameters': None}
         )
-
-        # Replace regexp_instr with a combination of regexp_extract and length
-        regexp_instr_repl = (
-            r'(WITH regexp_match AS '
-            r'(SELECT regexp_extract(\1, \2, 0) as match) '
-            r'SELECT CASE WHEN match IS NOT NULL '
-            r'THEN length(match) ELSE 0 END FROM regexp_match)'
+        extract_all = exp.RegexpExtractAll(
+            this=self._transform(node.this),
+            expression=self._transform(node.expression)
         )
-        sql = re.sub(
-            r'regexp_instr\((.*?),\s*(.*?)(?:,\s*(\d+))?\)',
-            regexp_instr_repl,
-            sql,
-            flags=re.IGNORECASE
+        return _cte_subquery(
+            'regexp_matches', 'matches', extract_all,
+            exp.ArraySize(this=exp.column('matches'))
         )
 
-        # Handle regexp_count
-        regexp_count_repl = (
-            r'(WITH regexp_matches AS '
-            r'(SELECT regexp_extract_all(\1, \2) as matches) '
-            r'SELECT size(matches) FROM regexp_matches)'
-        )
-        sql = re.sub(
-            r'regexp_count\((.*?),\s*(.*?)(?:,\s*(\d+))?\)',
-            regexp_count_repl,
-            sql,
-            flags=re.IGNORECASE
-        )
-        return sql
+    def _rewrite(self, node: exp.Expression) -> exp.Expression:
+        """Rewrite a single node into its Databricks form."""
+        if (isinstance(node, exp.Window) and
+                isinstance(node.this, exp.IgnoreNulls)):
+            return self._handle_ignore_nulls(node)
+        if isinstance(node, exp.Add):
+            return self._handle_string_concat(node)
+        if isinstance(node, exp.RegexpExtract):
+            return self._handle_regexp_substr(node)
+        if isinstance(node, exp.RegexpInstr):
+            return self._handle_regexp_instr(node)
+        if isinstance(node, exp.RegexpCount):
+            return self._handle_regexp_count(node)
+        return node
+
+    def _transform(self, sql_exp: exp.Expression) -> exp.Expression:
+        """Apply node rewrites to a subtree in a single pre-order pass."""
+        # transform() does not descend into nodes a rewrite replaces, so
+        # rewrites that build new nodes call this on the operands they keep
+        return sql_exp.transform(self._rewrite, copy=False)
 
     def _apply_transformations(
         self, sql_exp: exp.Expression
     ) -> exp.Expression:
         """Apply all SQL transformations to an expression."""
 
+        sql_exp = self._transform(sql_exp)
         sql_exp = self._handle_column_aliases(sql_exp)
-        sql_exp = self._handle_ignore_nulls(sql_exp)
-        sql_exp = self._handle_string_concat(sql_exp)
-        sql_exp = self._handle_regexp_functions(sql_exp)
         return sql_exp
 
     def _sort_ctes_topologically(self) -> List[str]:
         """Sort CTEs in topological order based on dependencies."""
-        visited = set()
+        order = {cte_name: i for i, cte_name in enumerate(self.cte_graph)}
+        in_degree = {
+            cte_name: len(node.references & self.cte_graph.keys())
+            for cte_name, node in self.cte_graph.items()
+        }
+        queue = deque(
+            cte_name for cte_name, degree in in_degree.items() if degree == 0
+        )
         sorted_ctes = []
 
-        def visit(cte_name: str) -> None:
-            if cte_name in visited:
-                return
-            visited.add(cte_name)
-            for ref in self.cte_graph[cte_name].references:
-                if ref in self.cte_graph:
-                    visit(ref)
+        while queue:
+            cte_name = queue.popleft()
             sorted_ctes.append(cte_name)
-
-        for cte_name in self.cte_graph:
-            visit(cte_name)
+            # Release dependents in definition order to keep output stable
+            dependents = sorted(
+                self.cte_graph[cte_name].referenced_by, key=order.get
+            )
+            for dependent in dependents:
+                in_degree[dependent] -= 1
+                if in_degree[dependent] == 0:
+                    queue.append(dependent)
+
+        # Keep any CTEs caught in a dependency cycle, in definition order
+        if len(sorted_ctes) < len(self.cte_graph):
+            emitted = set(sorted_ctes)
+            sorted_ctes.extend(
+                cte_name for cte_name in self.cte_graph
+                if cte_name not in emitted
+            )
         return sorted_ctes
 
+    def _detach_ctes(
+        self, sql_exp: exp.Expression
+    ) -> Tuple[Dict[str, exp.CTE], bool]:
+        """Remove CTE definitions that are emitted from the graph instead."""
+        # Also reports whether any WITH they came from was RECURSIVE
+        detached = {}
+        recursive = False
+        # CTE bodies are searched too, since the main query may itself
+        # have been moved into a generated CTE
+        trees = [sql_exp] + [node.sql for node in self.cte_graph.values()]
+        for tree in trees:
+            for cte in list(tree.find_all(exp.CTE)):
+                node = self.cte_graph.get(cte.alias)
+                if (node is None or node.sql is not cte.this or
+                        cte.parent is None):
+                    continue
+                with_ = cte.parent
+                recursive = recursive or bool(with_.args.get('recursive'))
+                detached[node.name] = cte.pop()
+                if not with_.expressions:
+                    with_.pop()
+        return detached, recursive
+
+    def _graph_ctes(
+        self, sorted_ctes: List[str], detached: Dict[str, exp.CTE]
+    ) -> Iterator[exp.CTE]:
+        """Yield CTE expressions for graph nodes in the given order."""
+        for cte_name in sorted_ctes:
+            # Reuse the parsed CTE wrapper; only generated CTEs need one built
+            cte = detached.get(cte_name)
+            if cte is None:
+                cte = exp.CTE(
+                    this=self.cte_graph[cte_name].sql,
+                    alias=exp.TableAlias(this=exp.to_identifier(cte_name))
+                )
+            yield cte
+
     def translate(self, sql: str) -> str:
         """Translate Redshift SQL to Databricks SQL."""
-        # Parse SQL using sqlglot
-        sql_exp = parse_one(sql, read=Redshift)
+        return ''.join(self.translate_stream(sql))
+
+    def translate_stream(self, sql: str) -> Iterator[str]:
+        """Translate Redshift SQL to Databricks SQL, yielding it in chunks."""
+        # Each call starts numbering generated CTEs afresh
+        self.cte_counter = 0
+        # Parse SQL using sqlglot; copy since the cached tree is shared
+        sql_exp = self._parse(sql).copy()
+        statements = (
+            sql_exp.expressions if isinstance(sql_exp, exp.Block)
+            else [sql_exp]
+        )
+        # Rewrite every statement before yielding anything, so a failure in
+        # a later statement surfaces before any output has been produced
+        prepared = [self._prepare_statement(s) for s in statements]
+        for i, (ctes, recursive, body) in enumerate(prepared):
+            if i:
+                yield '; '
+            # Emit ordered CTEs one at a time ahead of the main query
+            if ctes:
+                yield 'WITH RECURSIVE ' if recursive else 'WITH '
+                for j, cte in enumerate(ctes):
+                    if j:
+                        yield ', '
+                    # Convert to Databricks dialect
+                    yield self._gen.generate(cte)
+                yield ' '
+            yield self._gen.generate(body)
+
+    def _prepare_statement(
+        self, sql_exp: exp.Expression
+    ) -> Tuple[List[exp.CTE], bool, exp.Expression]:
+        """Rewrite a statement, returning its hoisted CTEs, the recursive
+        flag and the remaining body."""
+        # Each statement gets its own graph so CTEs stay in their statement
+        # and a reused translator does not carry CTEs over between inputs
+        self.cte_graph = {}
+
+        # CTEs can only be hoisted in front of a query; elsewhere, e.g. in
+        # CREATE TABLE ... AS WITH ..., they stay where they are
+        if not isinstance(sql_exp, (exp.Select, exp.SetOperation)):
+            return [], False, self._transform(sql_exp)
+
         # Build CTE graph
         self._build_cte_graph(sql_exp)
         # Apply transformations
         sql_exp = self._apply_transformations(sql_exp)
         # Sort CTEs topologically
         sorted_ctes = self._sort_ctes_topologically()
-
-        # Reconstruct SQL with ordered CTEs
-        if sorted_ctes:
-            cte_expressions = []
-            for cte_name in sorted_ctes:
-                node = self.cte_graph[cte_name]
-                cte_expressions.append(
-                    exp.CTE(
-                        this=node.sql,
-                        alias=exp.TableAlias(this=exp.to_identifier(cte_name))
-                    )
-                )
-            sql_exp = exp.With(
-                expressions=cte_expressions,
-                expression=sql_exp
-            )
-        # Convert to Databricks dialect
-        return sql_exp.sql(dialect=Databricks)
+        detached, recursive = self._detach_ctes(sql_exp)
+        ctes = list(self._graph_ctes(sorted_ctes, detached))
+        return ctes, recursive, sql_exp